@@ -3,6 +3,7 @@ import re
 from collections.abc import Generator
 from typing import Union
 
+import orjson
 from dify_plugin.entities.model.llm import LLMResultChunk
 from dify_plugin.interfaces.agent import AgentScratchpadUnit
 
@@ -14,7 +15,11 @@ class CotAgentOutputParser:
     ) -> Generator[Union[str, AgentScratchpadUnit.Action], None, None]:
         def parse_action(json_str):
             try:
-                action = json.loads(json_str, strict=False)
+                try:
+                    action = orjson.loads(json_str)
+                except orjson.JSONDecodeError:
+                    # fall back to the lenient decoder for control characters inside strings
+                    action = json.loads(json_str, strict=False)
                 action_name = None
                 action_input = None
 
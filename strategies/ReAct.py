@@ -1,3 +1,6 @@
+import copy
+import functools
+import os
 import time
 from collections.abc import Generator, Mapping
 from typing import Any, Optional, cast
@@ -32,7 +35,25 @@ from output_parser.cot_output_parser import CotAgentOutputParser
 from prompt.template import REACT_PROMPT_TEMPLATES
 from utils.mcp_client import McpClients
 
-ignore_observation_providers = ["wenxin"]
+ignore_observation_providers = frozenset({"wenxin"})
+final_answer_action_name = "final answer"
+# DEBUG_LOG is a process environment variable, not read from .env
+# include action_input in ROUND logs; tool calls also log it as tool_call_args and
+# final answers in the model log, so it is only repeated there when debugging
+debug_log = os.getenv("DEBUG_LOG", "false").lower() == "true"
+system_prompt_fields = ("instruction", "tools", "tool_names")
+
+
+@functools.cache
+def _compile_system_prompt_template(template: str) -> str:
+    """
+    Convert the {{field}} placeholders of system_prompt_fields into str.format fields,
+    escaping every other brace so the template can be rendered in a single pass
+    """
+    compiled = template.replace("{", "{{").replace("}", "}}")
+    for field in system_prompt_fields:
+        compiled = compiled.replace("{{{{" + field + "}}}}", "{" + field + "}")
+    return compiled
 
 
 class ReActParams(BaseModel):
@@ -62,6 +83,12 @@ class ReActAgentStrategy(AgentStrategy):
         self.instruction = ""
         self.history_prompt_messages = []
         self.prompt_messages_tools = []
+        self._prompt_tools_version = 0
+        self._cached_system_message: SystemPromptMessage | None = None
+        self._cached_system_message_version = -1
+        self._assistant_buffer: list[str] = []
+        self._assistant_formatted_upto = 0
+        self._prompt_tool_dumps: dict[int, dict] = {}
 
     @property
     def _user_prompt_message(self) -> UserPromptMessage:
@@ -77,26 +104,61 @@ class ReActAgentStrategy(AgentStrategy):
         )
         if not prompt_entity:
             raise ValueError("Agent prompt configuration is not set")
-        first_prompt = prompt_entity.first_prompt
+        first_prompt = _compile_system_prompt_template(prompt_entity.first_prompt)
 
-        system_prompt = (
-            first_prompt.replace("{{instruction}}", self.instruction)
-            .replace(
-                "{{tools}}",
-                orjson.dumps(
+        # sort tools by name so the rendered prompt is byte-stable regardless of tool order
+        prompt_messages_tools = sorted(self._prompt_messages_tools, key=lambda tool: tool.name)
+        system_prompt = first_prompt.format_map(
+            {
+                "instruction": self.instruction,
+                "tools": orjson.dumps(
                     [
-                        tool.model_dump(mode="json")
-                        for tool in self._prompt_messages_tools
+                        self._dump_prompt_tool(tool)
+                        for tool in prompt_messages_tools
                     ],
+                    option=orjson.OPT_SORT_KEYS,
                 ).decode('utf-8'),
-            )
-            .replace(
-                "{{tool_names}}",
-                ", ".join([tool.name for tool in self._prompt_messages_tools]),
-            )
+                "tool_names": ", ".join([tool.name for tool in prompt_messages_tools]),
+            }
         )
 
-        return SystemPromptMessage(content=system_prompt)
+        return SystemPromptMessage(content=system_prompt.strip())
+
+    def _dump_prompt_tool(self, tool: PromptMessageTool) -> dict:
+        """
+        Dump prompt message tool to json-compatible dict, cached until the tool is updated.
+        Keyed by id(tool) since Dify and MCP tools may share a name.
+        """
+        tool_dump = self._prompt_tool_dumps.get(id(tool))
+        if tool_dump is None:
+            tool_dump = tool.model_dump(mode="json")
+            self._prompt_tool_dumps[id(tool)] = tool_dump
+        return tool_dump
+
+    def _get_system_prompt_message(self) -> SystemPromptMessage:
+        """
+        Get the rendered system prompt, re-rendering only when the prompt tools changed
+        """
+        if (
+                self._cached_system_message is None
+                or self._cached_system_message_version != self._prompt_tools_version
+        ):
+            self._cached_system_message = self._system_prompt_message
+            self._cached_system_message_version = self._prompt_tools_version
+        return self._cached_system_message
+
+    def update_prompt_message_tool(
+            self, tool: ToolEntity, prompt_tool: PromptMessageTool
+    ) -> PromptMessageTool:
+        """
+        Update prompt message tool, invalidating the cached system prompt on change
+        """
+        parameters = copy.deepcopy(prompt_tool.parameters)
+        super().update_prompt_message_tool(tool, prompt_tool)
+        if prompt_tool.parameters != parameters:
+            self._prompt_tool_dumps.pop(id(prompt_tool), None)
+            self._prompt_tools_version += 1
+        return prompt_tool
 
     def _iter_cleanup_history_prompt_messages(self, model: AgentModelConfig):
         """
@@ -126,6 +188,9 @@ class ReActAgentStrategy(AgentStrategy):
                     name=msg.name,
                 )
                 yield new_msg
+            elif isinstance(msg.content, str):
+                # prevent Claude LLM errors caused by extra whitespace.
+                yield msg.model_copy(update={"content": msg.content.strip()})
             else:
                 yield msg
 
@@ -144,6 +209,8 @@ class ReActAgentStrategy(AgentStrategy):
         self.query = react_params.query
         self.instruction = react_params.instruction or self.instruction
         agent_scratchpad = []
+        self._assistant_buffer = []
+        self._assistant_formatted_upto = 0
         iteration_step = 1
         max_iteration_steps = react_params.maximum_iterations
         run_agent_state = True
@@ -172,6 +239,7 @@ class ReActAgentStrategy(AgentStrategy):
         # convert tools into ModelRuntime Tool format
         tools = react_params.tools
         tool_instances = {tool.identity.name: tool for tool in tools} if tools else {}
+        tool_providers = {name: tool.identity.provider for name, tool in tool_instances.items()}
 
         # Fetch MCP tools
         mcp_clients = None
@@ -195,8 +263,17 @@ class ReActAgentStrategy(AgentStrategy):
         )
         # convert tools into ModelRuntime Tool format
         prompt_messages_tools = self._init_prompt_tools(tools)
+        # index the Dify tools only, MCP tools sharing a name must never get Dify parameters
+        prompt_tools_by_name = {tool.name: tool for tool in prompt_messages_tools}
         prompt_messages_tools.extend(self._init_prompt_mcp_tools(mcp_tools))
         self._prompt_messages_tools = prompt_messages_tools
+        self._prompt_tool_dumps = {}
+        self._prompt_tools_version += 1
+        self._cached_system_message = self._system_prompt_message
+        self._cached_system_message_version = self._prompt_tools_version
+
+        # model is unchanged between rounds, only its completion params are recalculated in place
+        llm_model_config = LLMModelConfig(**model.model_dump(mode="json"))
 
         while run_agent_state and iteration_step <= max_iteration_steps:
             # continue to run until there is not any tool call
@@ -214,6 +291,7 @@ class ReActAgentStrategy(AgentStrategy):
             if iteration_step == max_iteration_steps:
                 # the last iteration, remove all tools
                 self._prompt_messages_tools = []
+                self._prompt_tools_version += 1
 
             message_file_ids: list[str] = []
 
@@ -221,19 +299,14 @@ class ReActAgentStrategy(AgentStrategy):
             prompt_messages = self._organize_prompt_messages(
                 agent_scratchpad, self.query
             )
-            if model.entity and model.completion_params:
+            if model.entity and llm_model_config.completion_params:
                 self.recalc_llm_max_tokens(
-                    model.entity, prompt_messages, model.completion_params
+                    model.entity, prompt_messages, llm_model_config.completion_params
                 )
 
-            # prevent Claude LLM errors caused by extra whitespace.
-            for i, msg in enumerate(prompt_messages):
-                if hasattr(msg, "content") and isinstance(msg.content, str):
-                    msg.content = msg.content.strip()
-
             # invoke model
             chunks = self.session.model.llm.invoke(
-                model_config=LLMModelConfig(**model.model_dump(mode="json")),
+                model_config=llm_model_config,
                 prompt_messages=prompt_messages,
                 stream=True,
                 stop=stop,
@@ -243,7 +316,8 @@ class ReActAgentStrategy(AgentStrategy):
             react_chunks = CotAgentOutputParser.handle_react_stream_output(
                 chunks, usage_dict
             )
-            scratchpad = AgentScratchpadUnit(
+            # fields are all known-good defaults, skip pydantic validation
+            scratchpad = AgentScratchpadUnit.model_construct(
                 agent_response="",
                 thought="",
                 action_str="",
@@ -264,20 +338,31 @@ class ReActAgentStrategy(AgentStrategy):
             )
             yield model_log
 
+            agent_response_parts: list[str] = []
+            thought_parts: list[str] = []
+            action_name_lower = ""
             for chunk in react_chunks:
                 if isinstance(chunk, AgentScratchpadUnit.Action):
                     action = chunk
                     # detect action
-                    assert scratchpad.agent_response is not None
-                    scratchpad.agent_response += orjson.dumps(chunk.model_dump()).decode('utf-8')
-
-                    scratchpad.action_str = orjson.dumps(chunk.model_dump()).decode('utf-8')
+                    action_str = orjson.dumps(chunk.model_dump()).decode('utf-8')
+                    agent_response_parts.append(action_str)
+                    scratchpad.action_str = action_str
                     scratchpad.action = action
+                    action_name_lower = action.action_name.lower()
+                    if action_name_lower == final_answer_action_name:
+                        # stop parsing at the final answer, any text after it is left out of the thought;
+                        # the stream is still drained because usage arrives in its last chunk
+                        react_chunks.close()
+                        for response in chunks:
+                            if response.delta.usage:
+                                usage_dict["usage"] = response.delta.usage
+                        break
                 else:
-                    scratchpad.agent_response = scratchpad.agent_response or ""
-                    scratchpad.thought = scratchpad.thought or ""
-                    scratchpad.agent_response += chunk
-                    scratchpad.thought += chunk
+                    agent_response_parts.append(chunk)
+                    thought_parts.append(chunk)
+            scratchpad.agent_response = "".join(agent_response_parts)
+            scratchpad.thought = "".join(thought_parts)
             scratchpad.thought = (
                 scratchpad.thought.strip()
                 if scratchpad.thought
@@ -298,13 +383,14 @@ class ReActAgentStrategy(AgentStrategy):
                 else {"action": scratchpad.agent_response}
             )
 
+            model_finished_at = time.perf_counter()
             yield self.finish_log_message(
                 log=model_log,
                 data={"thought": scratchpad.thought, **action},
                 metadata={
                     LogMetadata.STARTED_AT: model_started_at,
-                    LogMetadata.FINISHED_AT: time.perf_counter(),
-                    LogMetadata.ELAPSED_TIME: time.perf_counter() - model_started_at,
+                    LogMetadata.FINISHED_AT: model_finished_at,
+                    LogMetadata.ELAPSED_TIME: model_finished_at - model_started_at,
                     LogMetadata.PROVIDER: model.provider,
                     LogMetadata.TOTAL_PRICE: usage_dict["usage"].total_price
                     if usage_dict["usage"]
@@ -323,7 +409,7 @@ class ReActAgentStrategy(AgentStrategy):
             elif not scratchpad.action:
                 final_answer = scratchpad.thought
             else:
-                if scratchpad.action.action_name.lower() == "final answer":
+                if action_name_lower == final_answer_action_name:
                     # action is final answer, return final answer directly
                     try:
                         if isinstance(scratchpad.action.action_input, dict):
@@ -332,7 +418,7 @@ class ReActAgentStrategy(AgentStrategy):
                             final_answer = scratchpad.action.action_input
                         else:
                             final_answer = f"{scratchpad.action.action_input}"
-                    except orjson.JSONDecodeError:
+                    except orjson.JSONEncodeError:
                         final_answer = f"{scratchpad.action.action_input}"
                 else:
                     run_agent_state = True
@@ -343,12 +429,8 @@ class ReActAgentStrategy(AgentStrategy):
                         label=f"CALL {tool_name}",
                         data={},
                         metadata={
-                            LogMetadata.STARTED_AT: time.perf_counter(),
-                            LogMetadata.PROVIDER: tool_instances[
-                                tool_name
-                            ].identity.provider
-                            if tool_instances.get(tool_name)
-                            else "",
+                            LogMetadata.STARTED_AT: tool_call_started_at,
+                            LogMetadata.PROVIDER: tool_providers.get(tool_name, ""),
                         },
                         parent=round_log,
                         status=ToolInvokeMessage.LogMessage.LogStatus.START,
@@ -365,6 +447,7 @@ class ReActAgentStrategy(AgentStrategy):
                     )
                     scratchpad.observation = tool_invoke_response
                     scratchpad.agent_response = tool_invoke_response
+                    tool_call_finished_at = time.perf_counter()
                     yield self.finish_log_message(
                         log=tool_call_log,
                         data={
@@ -374,39 +457,44 @@ class ReActAgentStrategy(AgentStrategy):
                         },
                         metadata={
                             LogMetadata.STARTED_AT: tool_call_started_at,
-                            LogMetadata.PROVIDER: tool_instances[
-                                tool_name
-                            ].identity.provider
-                            if tool_instances.get(tool_name)
-                            else "",
-                            LogMetadata.FINISHED_AT: time.perf_counter(),
-                            LogMetadata.ELAPSED_TIME: time.perf_counter()
+                            LogMetadata.PROVIDER: tool_providers.get(tool_name, ""),
+                            LogMetadata.FINISHED_AT: tool_call_finished_at,
+                            LogMetadata.ELAPSED_TIME: tool_call_finished_at
                                                       - tool_call_started_at,
                         },
                     )
 
-                # update prompt tool message
-                for prompt_tool in self._prompt_messages_tools:
-                    if prompt_tool.name in tool_instances:
+                    # update prompt tool message of the invoked tool, the last round has no tools left
+                    prompt_tool = prompt_tools_by_name.get(tool_name)
+                    if (
+                            iteration_step < max_iteration_steps
+                            and prompt_tool
+                            and tool_name in tool_instances
+                    ):
                         self.update_prompt_message_tool(
-                            tool_instances[prompt_tool.name], prompt_tool
+                            tool_instances[tool_name], prompt_tool
                         )
+            round_log_data = {
+                "action_name": scratchpad.action.action_name
+                if scratchpad.action
+                else "",
+                "thought": scratchpad.thought,
+                "observation": scratchpad.observation,
+            }
+            if debug_log:
+                round_log_data["action_input"] = (
+                    scratchpad.action.action_input
+                    if scratchpad.action
+                    else ""
+                )
+            round_finished_at = time.perf_counter()
             yield self.finish_log_message(
                 log=round_log,
-                data={
-                    "action_name": scratchpad.action.action_name
-                    if scratchpad.action
-                    else "",
-                    "action_input": scratchpad.action.action_input
-                    if scratchpad.action
-                    else "",
-                    "thought": scratchpad.thought,
-                    "observation": scratchpad.observation,
-                },
+                data=round_log_data,
                 metadata={
                     LogMetadata.STARTED_AT: round_started_at,
-                    LogMetadata.FINISHED_AT: time.perf_counter(),
-                    LogMetadata.ELAPSED_TIME: time.perf_counter() - round_started_at,
+                    LogMetadata.FINISHED_AT: round_finished_at,
+                    LogMetadata.ELAPSED_TIME: round_finished_at - round_started_at,
                     LogMetadata.TOTAL_PRICE: usage_dict["usage"].total_price
                     if usage_dict["usage"]
                     else 0,
@@ -447,7 +535,7 @@ class ReActAgentStrategy(AgentStrategy):
         """
         Organize user query
         """
-        prompt_messages.append(UserPromptMessage(content=query))
+        prompt_messages.append(UserPromptMessage(content=query.strip()))
 
         return prompt_messages
 
@@ -456,31 +544,31 @@ class ReActAgentStrategy(AgentStrategy):
     ) -> list[PromptMessage]:
         """
         Organize
+
+        Messages are always ordered as [system, *historic, *query, *assistant]:
+        the system, historic and query messages form the STATIC_PREFIX and only the
+        assistant scratchpad (DYNAMIC_TAIL) grows from round to round, so providers
+        can reuse their prompt cache. The prefix does change, and the cache misses,
+        when the system prompt is re-rendered: on the last round, which drops all
+        tools, and after update_prompt_message_tool changes a tool schema.
         """
         # organize system prompt
-        system_message = self._system_prompt_message
+        system_message = self._get_system_prompt_message()
 
-        # organize current assistant messages
-        agent_scratchpad = agent_scratchpad
+        # organize current assistant messages, only formatting units added since the last round
         if not agent_scratchpad:
             assistant_messages = []
         else:
-            assistant_message = AssistantPromptMessage(content="")
-            for unit in agent_scratchpad:
-                if unit.is_final():
-                    assert isinstance(assistant_message.content, str)
-                    assistant_message.content += f"Final Answer: {unit.agent_response}"
-                else:
-                    assert isinstance(assistant_message.content, str)
-                    assistant_message.content += f"Thought: {unit.thought}\n\n"
-                    if unit.action_str:
-                        assistant_message.content += f"Action: {unit.action_str}\n\n"
-                    if unit.observation:
-                        assistant_message.content += (
-                            f"Observation: {unit.observation}\n\n"
-                        )
-
-            assistant_messages = [assistant_message]
+            if self._assistant_formatted_upto < len(agent_scratchpad):
+                self._assistant_buffer.append(
+                    self._format_assistant_message(
+                        agent_scratchpad[self._assistant_formatted_upto:]
+                    )
+                )
+                self._assistant_formatted_upto = len(agent_scratchpad)
+            assistant_messages = [
+                AssistantPromptMessage(content="".join(self._assistant_buffer).strip())
+            ]
 
         # query messages
         query_messages = self._organize_user_query(query, [])
@@ -640,14 +728,11 @@ class ReActAgentStrategy(AgentStrategy):
         """
         Initialize prompt message MCP tools
         """
-        prompt_messages_tools = []
-
-        for tool in mcp_tools:
-            prompt_message = PromptMessageTool(
+        return [
+            PromptMessageTool(
                 name=tool.get("name"),
                 description=tool.get("description", ""),
                 parameters=tool.get("inputSchema"),
             )
-            prompt_messages_tools.append(prompt_message)
-
-        return prompt_messages_tools
+            for tool in mcp_tools
+        ]
@@ -426,6 +426,9 @@ class ToolAction(BaseModel):
 
 
 class McpClients:
+    # upper bound on threads started per invoke inside the plugin process
+    MAX_WORKERS = 32
+
     def __init__(self, servers_config: dict[str, Any],
                  resources_as_tools: bool = False,
                  prompts_as_tools: bool = False):
@@ -436,7 +439,7 @@ class McpClients:
             for name, config in servers_config.items()
         }
         self._tool_actions_lock = Lock()
-        with ThreadPoolExecutor(max_workers=10) as executor:
+        with ThreadPoolExecutor(max_workers=min(max(len(self._clients), 1), self.MAX_WORKERS)) as executor:
             futures = [executor.submit(client.initialize) for client in self._clients.values()]
             wait(futures)
             for f in futures:
@@ -596,8 +599,11 @@ class McpClients:
             yield executor.submit(lambda: list(self._iter_prompts(server_name, client)))
 
     def fetch_tools(self) -> list[dict]:
+        # one listing call per server for tools, plus one each for resources and prompts if enabled
+        listings_per_server = 1 + int(self._resources_as_tools) + int(self._prompts_as_tools)
+        max_workers = min(max(len(self._clients) * listings_per_server, 1), self.MAX_WORKERS)
         try:
-            with ThreadPoolExecutor(max_workers=10) as executor:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
                 futures = tuple(chain.from_iterable((
                     self._iter_all_tools_futures(server_name=server_name, client=client, executor=executor)
                     for server_name, client in self._clients.items()